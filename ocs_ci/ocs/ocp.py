@@ -99,6 +99,28 @@ class OCP(object):
         """
         self._data = self.get()
 
+    def get_oc_cmd_prefix(self):
+        """
+        Get the beginning of an 'oc' command line: the oc binary, the
+        kubeconfig to use (if KUBECONFIG is not set) and the namespace
+
+        Returns:
+            list: the oc binary and its global arguments
+
+        """
+        oc_cmd = ["oc"]
+        env_kubeconfig = os.getenv("KUBECONFIG")
+        if not env_kubeconfig or not os.path.exists(env_kubeconfig):
+            cluster_dir_kubeconfig = os.path.join(
+                config.ENV_DATA["cluster_path"], config.RUN.get("kubeconfig_location")
+            )
+            if os.path.exists(cluster_dir_kubeconfig):
+                oc_cmd += ["--kubeconfig", cluster_dir_kubeconfig]
+
+        if self.namespace:
+            oc_cmd += ["-n", self.namespace]
+        return oc_cmd
+
     def exec_oc_cmd(
         self,
         command,
@@ -128,19 +150,7 @@ class OCP(object):
             str: If out_yaml_format is False.
 
         """
-        oc_cmd = "oc "
-        env_kubeconfig = os.getenv("KUBECONFIG")
-        if not env_kubeconfig or not os.path.exists(env_kubeconfig):
-            cluster_dir_kubeconfig = os.path.join(
-                config.ENV_DATA["cluster_path"], config.RUN.get("kubeconfig_location")
-            )
-            if os.path.exists(cluster_dir_kubeconfig):
-                oc_cmd += f"--kubeconfig {cluster_dir_kubeconfig} "
-
-        if self.namespace:
-            oc_cmd += f"-n {self.namespace} "
-
-        oc_cmd += command
+        oc_cmd = " ".join(self.get_oc_cmd_prefix()) + " " + command
         out = run_cmd(
             cmd=oc_cmd,
             secrets=secrets,
@@ -2,22 +2,236 @@
 Pillowfight Class to run various workloads and scale tests
 """
 import logging
+import signal
+import subprocess
 import tempfile
-import re
-from os import listdir
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache
 from os.path import join
 from shutil import rmtree
 from ocs_ci.utility.spreadsheet.spreadsheet_api import GoogleSpreadSheetAPI
 
+from ocs_ci.ocs.exceptions import CommandFailed, TimeoutExpiredError
 from ocs_ci.ocs.ocp import OCP
 from ocs_ci.ocs.resources.ocs import OCS
 from ocs_ci.ocs import constants
-from ocs_ci.ocs.utils import get_pod_name_by_pattern
-from ocs_ci.utility.utils import TimeoutSampler
 from ocs_ci.utility import utils, templating
 
 log = logging.getLogger(__name__)
 
+_OPS_PREFIX = "OPS/SEC"
+_PROBE_LEN = 256
+
+
+def _strip_nul(lines):
+    """
+    Drop the NUL characters couchbase sometimes writes into its log
+
+    Args:
+        lines (iterable): lines of the log
+
+    Yields:
+        str: the lines without NUL characters
+
+    """
+    for line in lines:
+        # Skip the copy of the line in the usual case of no NUL bytes
+        if "\x00" in line:
+            line = line.replace("\x00", "")
+        yield line
+
+
+def _copy_lines(lines, fd):
+    """
+    Write every line to fd as it is passed on
+
+    Args:
+        lines (iterable): lines of the log
+        fd (file): open file to write the lines to
+
+    Yields:
+        str: the lines, unchanged
+
+    """
+    for line in lines:
+        fd.write(line)
+        yield line
+
+
+def _split_hist_row(dline):
+    """
+    Split a histogram row like "[60   - 69  ]us |####### - 1234" into its
+    fields.  Anything not strictly of that shape is rejected: unsigned
+    numbers, "us" or "ms" unit, a bar of '#' and " - " before the count.
+
+    Args:
+        dline (str): log line
+
+    Returns:
+        tuple: min, max, unit and count strings, or None if the line is not
+            a histogram row
+
+    """
+    head, sep, tail = dline.partition("]")
+    if not sep or tail[:2] not in ("us", "ms") or tail[2:4] != " |":
+        return None
+    low, sep, high = head[1:].partition(" - ")
+    low = low.rstrip()
+    high = high.rstrip()
+    if not sep or not low.isdecimal() or not high.isdecimal():
+        return None
+    bars, sep, count = tail[4:].partition(" - ")
+    if not sep or bars.strip("#") or not count[:1].isdecimal():
+        return None
+    return low, high, tail[:2], count.split(maxsplit=1)[0]
+
+
+def parse_pillowfight_log(data_from_log):
+    """
+    Parse the output of a pillowfight pod, given as a string or as an
+    iterable of lines.  Skip the peculiarities in the couchbase log results
+    and generate a summary of the results.
+
+    The dictionary returned has four values; 'opspersec', 'resptimes',
+    'min_ops' and 'max_resp'.
+    opspersec is a list of ops per second numbers reported.
+    resptimes is a list of (min, max, count) tuples, one per histogram
+    row in the order they were reported.  min and max are the bounds of
+    a response time range in microseconds, and count is how many messages
+    fall within that range.
+    min_ops is the lowest ops per second value and max_resp the highest
+    max response time, both None when the log did not report any.
+
+    Args:
+        data_from_log (str or iterable): log data, either as a single
+            string or as an iterable of lines
+
+    Returns:
+        dict: ops per sec and response time information
+
+    """
+    if isinstance(data_from_log, str):
+        log.debug(f"Parsing couchbase log of {len(data_from_log)} characters")
+        data_from_log = data_from_log.split("\n")
+    return parse_pillowfight_log_stream(data_from_log)
+
+
+def parse_pillowfight_log_stream(fileobj):
+    """
+    Generate a summary of the pillowfight results one line at a time,
+    so the whole log never has to be held in memory.  See
+    parse_pillowfight_log for the format of the returned dictionary.
+
+    Args:
+        fileobj (iterable): open log file or any other iterable of lines
+
+    Returns:
+        dict: ops per sec and response time information
+
+    """
+    # The data in the couchbase logs is kind of abnormal.
+    # It contains histograms with invalid unicode charaters for yaml
+    # output (which is why out_yaml_format=False is used).
+    # It also seems to write a block of text inside another block at
+    # an unpredictable location.  The value good_txt below is the output
+    # of the log with that data removed..
+    #
+    # So what's left is a list of OPS/SEC values and a histogram of
+    # response times.  This routine organizes that data.
+
+    ops_per_sec = []
+    resp_hist = []
+    # Worst values are tracked during the single pass over the log
+    min_ops = None
+    max_resp = None
+    for dline in fileobj:
+        dline = dline.rstrip("\n")
+        try:
+            if dline.startswith(_OPS_PREFIX):
+                # Only the last field is needed, no need to split them all
+                dnumb = int(dline.rpartition(" ")[2].strip())
+                ops_per_sec.append(dnumb)
+                if min_ops is None or dnumb < min_ops:
+                    min_ops = dnumb
+                continue
+            # Cheap tests first, most lines are not histogram rows
+            if not dline.startswith("["):
+                continue
+            # The unit marker is near the start of a histogram row, so only
+            # that part is searched for it on huge garbage lines.  The row
+            # itself is split from the full line so the count is never cut.
+            probe = dline[:_PROBE_LEN]
+            if "]us " not in probe and "]ms " not in probe:
+                continue
+            row = _split_hist_row(dline)
+            if row is None:
+                continue
+            i1, i2, unit, count = row
+            i1 = int(i1)
+            i2 = int(i2)
+            if unit == "ms":
+                i1 *= 1000
+                i2 *= 1000
+            resp_hist.append((i1, i2, int(count)))
+            if max_resp is None or i2 > max_resp:
+                max_resp = i2
+        except ValueError:
+            log.info(f"{dline} -- contains invalid data")
+    ret_data = {
+        "opspersec": ops_per_sec,
+        "resptimes": resp_hist,
+        "min_ops": min_ops,
+        "max_resp": max_resp,
+    }
+    return ret_data
+
+
+def sanity_check(stats, min_ops=2000, max_resp=2000):
+    """
+    Make sure the worst cases for ops per second and response times are
+    within an acceptable range.
+
+    Args:
+        stats (dict): pillowfight results, as returned by parse_pillowfight_log
+        min_ops (int): minimum acceptable ops per second
+        max_resp (int): maximum acceptable response time in milliseconds
+
+    Raises:
+        Exception: If a worst case value is out of the acceptable range
+
+    """
+    stat1 = stats["min_ops"]
+    if stat1 is None:
+        raise Exception("No OPS/SEC values reported")
+    if stat1 < min_ops:
+        raise Exception(f"Worst OPS/SEC value reported is {stat1}")
+    if stats["max_resp"] is None:
+        raise Exception("No response times reported")
+    stat2 = stats["max_resp"] / 1000
+    if stat2 > max_resp:
+        raise Exception(f"Worst response time reported is {stat2} milliseconds")
+
+
+@lru_cache(maxsize=1)
+def _version_row():
+    """
+    Capture versions(OCP, OCS and Ceph) and test run name.  They do not change
+    during a run, so the underlying commands are executed only once.
+
+    Returns:
+        list: spreadsheet row with the versions and test run name
+
+    """
+    return [
+        f"ocp_version:{utils.get_cluster_version()}",
+        f"ocs_build_number:{utils.get_ocs_build_number()}",
+        f"ceph_version:{utils.get_ceph_version()}",
+        f"test_run_name:{utils.get_testrun_name()}",
+    ]
+
 
 class PillowFight(object):
     """
@@ -26,6 +240,11 @@ class PillowFight(object):
     """
 
     WAIT_FOR_TIME = 1800
+    POD_SELECTOR = "app=pillowfight"
+    LOGS_TIMEOUT = 600
+    WATCH_RESTART_SLEEP = 1
+    WATCH_MAX_RESTART_SLEEP = 30
+    WATCH_MAX_FAILURES = 5
     MIN_ACCEPTABLE_OPS_PER_SEC = 2000
     MAX_ACCEPTABLE_RESPONSE_TIME = 2000
 
@@ -39,6 +258,8 @@ class PillowFight(object):
                 repo: PillowFight repo to used - a github link
                 branch: branch to use from the repo
                 namespace: namespace for the operator
+                save_logs: keep the raw pillowfight logs in the self.logs
+                    directory (default: False)
 
         Example Usage:
             r1 = PillowFight()
@@ -56,13 +277,16 @@ class PillowFight(object):
         self.namespace = self.args.get("namespace", "couchbase-operator-namespace")
         self.ocp = OCP()
         self.up_check = OCP(namespace=constants.COUCHBASE_OPERATOR)
+        self.save_logs = self.args.get("save_logs", False)
         self.logs = tempfile.mkdtemp(prefix="pf_logs_")
+        self.results = {}
 
     def run_pillowfights(self, replicas=1, num_items=None, num_threads=None):
         """
         loop through all the yaml files extracted from the pillowfight repo
-        and run them.  Run oc logs on the results and save the logs in self.logs
-        directory
+        and run them.  Run oc logs on the results and store the parsed data
+        in self.results (the raw logs are saved in self.logs directory only
+        if save_logs was requested)
 
         Args:
             replicas (int): Number of pod replicas
@@ -70,147 +294,216 @@ class PillowFight(object):
             num_threads (int): Number of threads
 
         """
-        ocp_local = OCP(namespace=self.namespace)
         self.replicas = replicas
+        # for basic-fillowfight.yaml, parsed once and copied for every replica
+        base_pfight = templating.load_yaml(constants.COUCHBASE_NEW_PILLOWFIGHT)
+        items = str(num_items) if num_items else "20000"
+        threads = str(num_threads) if num_threads else "20"
         for i in range(self.replicas):
-            # for basic-fillowfight.yaml
-            pfight = templating.load_yaml(constants.COUCHBASE_NEW_PILLOWFIGHT)
+            pfight = deepcopy(base_pfight)
             pfight["metadata"]["name"] = "pillowfight-rbd-simple" + f"{i}"
+            command = pfight["spec"]["template"]["spec"]["containers"][0]["command"]
             # change the name
-            pfight["spec"]["template"]["spec"]["containers"][0]["command"][2] = (
+            command[2] = (
                 f"couchbase://cb-example-000{i}.cb-example."
                 f"couchbase-operator-namespace.svc:8091/default?select_bucket=true"
             )
             # num of items
-            pfight["spec"]["template"]["spec"]["containers"][0]["command"][4] = (
-                str(num_items) if num_items else "20000"
-            )
+            command[4] = items
             # num of threads
-            pfight["spec"]["template"]["spec"]["containers"][0]["command"][13] = (
-                str(num_threads) if num_threads else "20"
-            )
+            command[13] = threads
             lpillowfight = OCS(**pfight)
             lpillowfight.create()
-        self.pods_info = {}
-
-        for pillowfight_pods in TimeoutSampler(
-            self.WAIT_FOR_TIME,
-            9,
-            get_pod_name_by_pattern,
-            "pillowfight",
-            constants.COUCHBASE_OPERATOR,
-        ):
-            try:
-                counter = 0
-                for pf_pod in pillowfight_pods:
-                    pod_info = self.up_check.exec_oc_cmd(f"get pods {pf_pod} -o json")
-                    pf_status = pod_info["status"]["containerStatuses"][0]["state"]
-                    if "terminated" in pf_status:
-                        pf_completion_info = pf_status["terminated"]["reason"]
-                        if pf_completion_info == constants.STATUS_COMPLETED:
-                            counter += 1
-                            self.pods_info.update({pf_pod: pf_completion_info})
-                    elif "running" in pf_status:
-                        pass
-                if counter == self.replicas:
-                    break
-            except IndexError:
-                log.info("Pillowfight not yet completed")
+        self.pods_info = self._wait_for_pods_completion()
 
         log.info(self.pods_info)
-        for pod, pf_completion_info in self.pods_info.items():
-            if pf_completion_info == "Completed":
-                pf_endlog = f"{pod}.log"
-                pf_log = join(self.logs, pf_endlog)
-                data_from_log = ocp_local.exec_oc_cmd(
-                    f"logs -f {pod} --ignore-errors", out_yaml_format=False
-                )
-                data_from_log = data_from_log.replace("\x00", "")
-                with open(pf_log, "w") as fd:
-                    fd.write(data_from_log)
+        completed = list(self.pods_info)
+        if completed:
+            # Each fetch just waits on an oc subprocess, so run them side by side
+            with ThreadPoolExecutor(max_workers=min(16, len(completed))) as executor:
+                futures = [executor.submit(self._fetch_log, pod) for pod in completed]
+                for future in futures:
+                    future.result()
+
+    def _fetch_log(self, pod):
+        """
+        Parse the log of a completed pillowfight pod while it is read from
+        oc logs, and store the result in self.results
+
+        Args:
+            pod (str): name of the pod
 
-            elif pf_completion_info == "Error":
-                raise Exception("Pillowfight failed to complete")
+        Raises:
+            CommandFailed: If oc logs fails
+
+        """
+        oc_cmd = OCP(namespace=self.namespace).get_oc_cmd_prefix() + [
+            "logs",
+            pod,
+            "--ignore-errors",
+        ]
+        log.info(f"Executing command: {' '.join(oc_cmd)}")
+        pf_log = join(self.logs, f"{pod}.log")
+        # stderr goes to a file so that it can never fill a pipe and block oc
+        with tempfile.TemporaryFile(mode="w+") as err_fd:
+            with subprocess.Popen(
+                oc_cmd,
+                stdout=subprocess.PIPE,
+                stderr=err_fd,
+                encoding="utf-8",
+            ) as proc:
+                # Same limit exec_oc_cmd applies, so a stuck oc can't hang the run
+                timer = threading.Timer(self.LOGS_TIMEOUT, proc.kill)
+                timer.start()
+                try:
+                    lines = _strip_nul(proc.stdout)
+                    if self.save_logs:
+                        with open(pf_log, "w") as fd:
+                            results = parse_pillowfight_log_stream(
+                                _copy_lines(lines, fd)
+                            )
+                    else:
+                        results = parse_pillowfight_log_stream(lines)
+                finally:
+                    timer.cancel()
+            timed_out = proc.returncode == -signal.SIGKILL
+            err_fd.seek(0)
+            err = err_fd.read()
+        if err:
+            log.warning(f"Command stderr: {err}")
+        if timed_out:
+            raise CommandFailed(
+                f"Timed out after {self.LOGS_TIMEOUT}s running: {' '.join(oc_cmd)}"
+            )
+        if proc.returncode:
+            raise CommandFailed(
+                f"Error during execution of command: {' '.join(oc_cmd)}."
+                f"\nError is {err}"
+            )
+        self.results[pod] = results
+
+    def _wait_for_pods_completion(self):
+        """
+        Watch the pillowfight pods and return as soon as all replicas have
+        completed.  Status changes are consumed from 'oc get pods --watch' as
+        they happen rather than by polling the API server.
+
+        Returns:
+            dict: names of the completed pods mapped to their completion reason
+
+        Raises:
+            Exception: As soon as a pod terminates with a reason other than
+                Completed (e.g. Error)
+            CommandFailed: If oc fails WATCH_MAX_FAILURES times in a row
+            TimeoutExpiredError: If the pods did not complete in WAIT_FOR_TIME
+
+        """
+        oc_cmd = self.up_check.get_oc_cmd_prefix() + [
+            "get",
+            "pods",
+            "-l",
+            self.POD_SELECTOR,
+            "--watch",
+            "-o",
+            "jsonpath={.metadata.name} "
+            '{.status.containerStatuses[*].state.terminated.reason}{"\\n"}',
+        ]
+
+        pods_info = {}
+        failures = 0
+        restart_sleep = self.WATCH_RESTART_SLEEP
+        deadline = time.time() + self.WAIT_FOR_TIME
+        while time.time() < deadline:
+            log.info(f"Executing command: {' '.join(oc_cmd)}")
+            # stderr goes to a file so that it can never fill a pipe and block oc
+            with tempfile.TemporaryFile(mode="w+") as err_fd:
+                proc = subprocess.Popen(
+                    oc_cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=err_fd,
+                    encoding="utf-8",
+                )
+                # Stop waiting on the watch once the overall timeout expires
+                timer = threading.Timer(deadline - time.time(), proc.kill)
+                timer.start()
+                try:
+                    for event in proc.stdout:
+                        pf_pod, _, pf_completion_info = event.strip().partition(" ")
+                        if not pf_completion_info:
+                            # Not terminated yet
+                            continue
+                        if pf_completion_info != constants.STATUS_COMPLETED:
+                            raise Exception(
+                                f"Pillowfight failed to complete, pod {pf_pod} "
+                                f"terminated with reason {pf_completion_info}"
+                            )
+                        pods_info[pf_pod] = pf_completion_info
+                        if len(pods_info) == self.replicas:
+                            return pods_info
+                finally:
+                    timer.cancel()
+                    proc.kill()
+                    proc.wait()
+                err_fd.seek(0)
+                err = err_fd.read()
+            if err:
+                log.warning(f"Command stderr: {err}")
+            if proc.returncode and time.time() < deadline:
+                # oc failed on its own, e.g. bad kubeconfig or missing rights
+                failures += 1
+                if failures >= self.WATCH_MAX_FAILURES:
+                    raise CommandFailed(
+                        f"Error during execution of command: {' '.join(oc_cmd)}."
+                        f"\nError is {err}"
+                    )
+                restart_sleep = min(restart_sleep * 2, self.WATCH_MAX_RESTART_SLEEP)
+            else:
+                # The API server closes watches periodically, start a new one
+                failures = 0
+                restart_sleep = self.WATCH_RESTART_SLEEP
+            log.info("Pillowfight not yet completed")
+            time.sleep(min(restart_sleep, max(deadline - time.time(), 0)))
+        raise TimeoutExpiredError(
+            self.WAIT_FOR_TIME, f"Pillowfight pods did not complete: {pods_info}"
+        )
 
     def analyze_all(self):
         """
-        Analyze the data extracted into self.logs files
+        Analyze the data parsed from the pillowfight pod logs
 
         """
-        for path in listdir(self.logs):
-            full_path = join(self.logs, path)
-            log.info(f"Analyzing {full_path}")
-            with open(full_path, "r") as fdesc:
-                data_from_log = fdesc.read()
-            log_data = self.parse_pillowfight_log(data_from_log)
+        for pod, log_data in self.results.items():
+            log.info(f"Analyzing {pod}")
             self.sanity_check(log_data)
 
     def sanity_check(self, stats):
         """
         Make sure the worst cases for ops per second and response times are
-        within an acceptable range.
+        within the acceptable range of this workload, see sanity_check at
+        module level.
 
         """
-        stat1 = min(stats["opspersec"])
-        if stat1 < self.MIN_ACCEPTABLE_OPS_PER_SEC:
-            raise Exception(f"Worst OPS/SEC value reported is {stat1}")
-        stat2 = max(stats["resptimes"].keys()) / 1000
-        if stat2 > self.MAX_ACCEPTABLE_RESPONSE_TIME:
-            raise Exception(f"Worst response time reported is {stat2} milliseconds")
-
-    def parse_pillowfight_log(self, data_from_log):
-        """
-        Run oc logs on the pillowfight pod passed in.  Cleanup the output
-        from oc logs to handle peculiarities in the couchbase log results,
-        and generate a summary of the results.
+        sanity_check(
+            stats, self.MIN_ACCEPTABLE_OPS_PER_SEC, self.MAX_ACCEPTABLE_RESPONSE_TIME
+        )
 
-        The dictionary returned has two values; 'opspersec' and 'resptimes'.
-        opspersec is a list of ops per second numbers reported.'
-        resptimes is a dictionary index by the max response time of a range.
-        Each entry in resptimes contains a minimum response time for that range,
-        and a count of how many messages fall within that range.
+    @staticmethod
+    def parse_pillowfight_log(data_from_log):
+        """
+        Generate a summary of the pillowfight results, see
+        parse_pillowfight_log at module level.
 
-        Args:
-            data_from_log (str): log data
+        """
+        return parse_pillowfight_log(data_from_log)
 
-        Returns:
-            dict: ops per sec and response time information
+    @staticmethod
+    def parse_pillowfight_log_stream(fileobj):
+        """
+        Generate a summary of the pillowfight results one line at a time, see
+        parse_pillowfight_log_stream at module level.
 
         """
-        # The data in the couchbase logs is kind of abnormal.
-        # It contains histograms with invalid unicode charaters for yaml
-        # output (which is why out_yaml_format=False is used).
-        # It also seems to write a block of text inside another block at
-        # an unpredictable location.  The value good_txt below is the output
-        # of the log with that data removed..
-        #
-        # So what's left is a list of OPS/SEC values and a histogram of
-        # response times.  This routine organizes that data.
-
-        ops_per_sec = []
-        resp_hist = {}
-        log.info("*******Couchbase raw output log*********\n" f"{data_from_log}")
-        lines = data_from_log.split("\n")
-        for dline in lines:
-            try:
-                if dline.startswith("OPS/SEC"):
-                    dfields = dline.split(" ")
-                    dnumb = int(dfields[-1].strip())
-                    ops_per_sec.append(dnumb)
-                if re.match("^\\[\\d+ +- \\d+ *\\][um]s \\|#* - \\d+", dline):
-                    for element in ["[", "]", "|", "-", "#"]:
-                        dline = dline.replace(element, " ")
-                    parts = dline.split()
-                    i1 = int(parts[0])
-                    i2 = int(parts[1])
-                    if parts[2] == "ms":
-                        i1 *= 1000
-                        i2 *= 1000
-                    resp_hist[i2] = {"minindx": i1, "number": int(parts[3])}
-            except ValueError:
-                log.info(f"{dline} -- contains invalid data")
-        ret_data = {"opspersec": ops_per_sec, "resptimes": resp_hist}
-        return ret_data
+        return parse_pillowfight_log_stream(fileobj)
 
     def export_pfoutput_to_googlesheet(self, sheet_name, sheet_index):
         """
@@ -224,32 +517,25 @@ class PillowFight(object):
         # Collect data and export to Google doc spreadsheet
         g_sheet = GoogleSpreadSheetAPI(sheet_name=sheet_name, sheet_index=sheet_index)
         log.info("Exporting pf data to google spreadsheet")
-        for path in listdir(self.logs):
-            full_path = join(self.logs, path)
-            with open(full_path, "r") as fdesc:
-                data_from_log = fdesc.read()
-            log_data = self.parse_pillowfight_log(data_from_log)
-
-            g_sheet.insert_row(
+        pf_rows = []
+        for pod, log_data in self.results.items():
+            min_ops = log_data["min_ops"]
+            max_resp = log_data["max_resp"]
+            if min_ops is None or max_resp is None:
+                log.warning(f"No OPS/SEC or response time values reported by {pod}")
+            # Values a log did not report are left as empty cells
+            pf_rows.append(
                 [
-                    f"{path}",
-                    min(log_data["opspersec"]),
-                    max(log_data["resptimes"].keys()) / 1000,
-                ],
-                2,
+                    f"{pod}.log",
+                    "" if min_ops is None else min_ops,
+                    "" if max_resp is None else max_resp / 1000,
+                ]
             )
-        g_sheet.insert_row(["", "opspersec", "resptimes"], 2)
-
-        # Capturing versions(OCP, OCS and Ceph) and test run name
-        g_sheet.insert_row(
-            [
-                f"ocp_version:{utils.get_cluster_version()}",
-                f"ocs_build_number:{utils.get_ocs_build_number()}",
-                f"ceph_version:{utils.get_ceph_version()}",
-                f"test_run_name:{utils.get_testrun_name()}",
-            ],
-            2,
-        )
+        header_row = ["", "opspersec", "resptimes"]
+
+        # Send everything in one request, keeping the layout the rows had when
+        # they were inserted one at a time on top of each other
+        g_sheet.insert_rows([_version_row(), header_row] + pf_rows[::-1], 2)
 
     def cleanup(self):
         """
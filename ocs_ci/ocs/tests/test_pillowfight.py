@@ -0,0 +1,107 @@
+# -*- coding: utf8 -*-
+
+import io
+import textwrap
+
+import pytest
+
+from ocs_ci.ocs import pillowfight
+
+
+@pytest.fixture
+def pillowfight_output():
+    """
+    Example of cbc-pillowfight output with timings (-T) enabled. Based on
+    actual test run.
+    """
+    pf_out = textwrap.dedent(
+        """\
+        Running. Press Ctrl-C to terminate...
+        Thread 0 has finished populating.
+        OPS/SEC:      22731
+        OPS/SEC:      23514
+        OPS/SEC:      24022
+        [60   - 69  ]us |# - 26
+        [70   - 79  ]us |###### - 143
+        [80   - 89  ]us |######################################## - 884
+        [90   - 99  ]us |##################### - 472
+        [100  - 199 ]us |############## - 318
+        [1    - 1   ]ms |# - 12
+        [2    - 2   ]ms | - 3
+        """
+    )
+    return pf_out
+
+
+def test_parse_pillowfight_log(pillowfight_output):
+    stats = pillowfight.parse_pillowfight_log(pillowfight_output)
+    assert stats["opspersec"] == [22731, 23514, 24022]
+    assert stats["resptimes"] == [
+        (60, 69, 26),
+        (70, 79, 143),
+        (80, 89, 884),
+        (90, 99, 472),
+        (100, 199, 318),
+        (1000, 1000, 12),
+        (2000, 2000, 3),
+    ]
+    assert stats["min_ops"] == 22731
+    assert stats["max_resp"] == 2000
+
+
+def test_parse_pillowfight_log_stream(pillowfight_output):
+    stats = pillowfight.parse_pillowfight_log_stream(io.StringIO(pillowfight_output))
+    assert stats == pillowfight.parse_pillowfight_log(pillowfight_output)
+
+
+def test_parse_pillowfight_log_empty():
+    stats = pillowfight.parse_pillowfight_log("")
+    assert stats == {
+        "opspersec": [],
+        "resptimes": [],
+        "min_ops": None,
+        "max_resp": None,
+    }
+    with pytest.raises(Exception, match="No OPS/SEC values reported"):
+        pillowfight.sanity_check(stats)
+
+
+def test_parse_pillowfight_log_nul_bytes(pillowfight_output):
+    # couchbase sometimes writes NUL characters in the middle of its log
+    nul_output = pillowfight_output.replace("OPS/SEC", "\x00\x00OPS/SEC")
+    nul_output = nul_output.replace("[80 ", "\x00[80 ")
+    lines = io.StringIO(nul_output)
+    stats = pillowfight.parse_pillowfight_log_stream(pillowfight._strip_nul(lines))
+    assert stats == pillowfight.parse_pillowfight_log(pillowfight_output)
+
+
+@pytest.mark.parametrize(
+    "dline",
+    [
+        "[-5 - 6]us |# - 1",
+        "[100 - 200]us |# 7",
+        "[ 10 - 19]us |# - 1",
+        "[1 - 2]ks |# - 3",
+        "[1 - 2]us |#a - 3",
+    ],
+)
+def test_parse_pillowfight_log_malformed_rows(dline):
+    assert pillowfight.parse_pillowfight_log(dline)["resptimes"] == []
+
+
+@pytest.mark.parametrize("bars", [231, 232, 235, 236, 240])
+def test_parse_pillowfight_log_long_row(bars):
+    # Rows just over the length of the unit marker probe must keep their count
+    dline = "[100  - 199 ]us |" + "#" * bars + " - 123456"
+    assert 257 <= len(dline) <= 266
+    stats = pillowfight.parse_pillowfight_log(dline)
+    assert stats["resptimes"] == [(100, 199, 123456)]
+
+
+def test_sanity_check(pillowfight_output):
+    stats = pillowfight.parse_pillowfight_log(pillowfight_output)
+    pillowfight.sanity_check(stats)
+    with pytest.raises(Exception, match="Worst OPS/SEC value reported is 22731"):
+        pillowfight.sanity_check(stats, min_ops=23000)
+    with pytest.raises(Exception, match="Worst response time reported is 2.0"):
+        pillowfight.sanity_check(stats, max_resp=1)
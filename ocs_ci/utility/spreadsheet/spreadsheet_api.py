@@ -42,3 +42,10 @@ class GoogleSpreadSheetAPI(object):
 
     def insert_row(self, value, row_index=2):
         return self.sheet.insert_row(value, row_index)
+
+    def insert_rows(self, values, row_index=2):
+        """
+        Inserts several rows in a single request, the first one of the
+        values ends up at row_index
+        """
+        return self.sheet.insert_rows(values, row_index)